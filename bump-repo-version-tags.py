@@ -2,43 +2,61 @@
 
 From inside a repo on master branch, increment the repo version by the
 specified increment type and create new tags for PATCH, MINOR, and MAJOR
-versions that point to the current commit. If the tag already exists, delete
-the old tag before creating the new one.
+versions that point to the current commit. If the tag already exists, it is
+replaced by the new one.
 """
 
+from __future__ import annotations
+
 import argparse
-import git # pip install gitpython
 import os
-from pkg_resources import parse_version
 import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import git
+
+# Only full MAJOR.MINOR.PATCH tags are considered versions
+VERSION_REGEX = re.compile(r"([0-9]+)\.([0-9]+)\.([0-9]+)")
+
+def get_version_tag_refspecs(repo: git.Repo) -> list:
+    # Only fetch version tags that are missing or out of date locally rather
+    # than pulling every tag on the remote
+    local_tags = {}
+    for tag in repo.tags:
+        local_tags[tag.name] = (tag.tag or tag.commit).hexsha
+
+    refspecs = []
+    for line in repo.git.ls_remote("--tags", "--refs", "origin").splitlines():
+        sha, ref = line.split("\t")
+        name = ref[len("refs/tags/"):]
+        if VERSION_REGEX.match(name) and local_tags.get(name) != sha:
+            refspecs.append(f"+{ref}:{ref}")
+
+    return refspecs
 
 def prepare_repo(repo: git.Repo):
     if repo.active_branch.name != "master":
         raise RuntimeError("Can only create a new release from 'master' branch")
 
-    try:
-        repo.remotes.origin.pull("--tags")
-    except (git.exc.GitCommandError):
-        raise RuntimeError("Failed to pull from remote. Please run "
-                           "`git pull --tags` and resolve any issues before "
-                           "retrying")
+    refspecs = ["master"] + get_version_tag_refspecs(repo)
+    repo.remotes.origin.fetch(refspec=refspecs, no_tags=True)
+    repo.git.merge("--ff-only", "origin/master")
 
-def get_latest_version(tags: list) -> str:
-    latest_version = parse_version("0.0.0")
+def get_latest_version(tags: list) -> list:
+    latest_version = (0, 0, 0)
 
     for tag_object in tags:
-        # Only check full MAJOR.MINOR.PATCH tags
-        if not re.match(r"[0-9]+\.[0-9]+\.[0-9]+", tag_object.name):
+        match = VERSION_REGEX.match(tag_object.name)
+        if not match:
             continue
 
-        version = parse_version(tag_object.name)
+        version = tuple(map(int, match.groups()))
 
         if version > latest_version:
             latest_version = version
 
-    latest_version_list = list(map(int, latest_version.base_version.split(".")))
-
-    return latest_version_list
+    return list(latest_version)
 
 def increment_version(version_list: list, increment: str) -> list:
     if increment == "PATCH":
@@ -53,21 +71,18 @@ def increment_version(version_list: list, increment: str) -> list:
 
     return version_list
 
-def create_tag(version: str, message: str, repo: git.Repo):
-    # delete old tag if it exists
-    try:
-        repo.delete_tag(version)
-        repo.remotes.origin.push(f":{version}")
-    except:
-        pass
-
-    repo.create_tag(version, message=message)
-    repo.remotes.origin.push(version)
-
 def main(increment: str, message: str):
+    # Imported here so --help and argument errors don't pay the import cost
+    import git # pip install gitpython
+
     repo = git.Repo(os.getcwd())
 
-    prepare_repo(repo)
+    try:
+        prepare_repo(repo)
+    except (git.exc.GitCommandError):
+        raise RuntimeError("Failed to pull from remote. Please run "
+                           "`git pull --tags` and resolve any issues before "
+                           "retrying")
 
     latest_version_list = get_latest_version(repo.tags)
 
@@ -77,9 +92,15 @@ def main(increment: str, message: str):
     minor_tag = ".".join(map(str, new_version_list[:2]))
     major_tag = str(new_version_list[0])
 
-    create_tag(patch_tag, message, repo)
-    create_tag(minor_tag, message, repo)
-    create_tag(major_tag, message, repo)
+    # Creating the tags is local and fast, so there is nothing to gain from
+    # doing it concurrently. The only network round trip is the push below.
+    tags = [patch_tag, minor_tag, major_tag]
+    for tag in tags:
+        repo.create_tag(tag, message=message, force=True)
+
+    # Force update all of the tags on the remote in a single atomic push
+    repo.remotes.origin.push(
+        refspec=[f"+refs/tags/{tag}" for tag in tags], atomic=True)
 
     print(f"Created the following tags: {patch_tag}, {minor_tag}, {major_tag}")
 
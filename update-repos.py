@@ -8,119 +8,781 @@ A common use case is if you have all repos that use a certain tool include the
 tool name in the repo name or topic list and you would like to update the
 pinned version of a package across the entire organization.
 
-Must have https://github.com/ggreer/the_silver_searcher#installing installed
-if you're not providing a target_file
+If https://github.com/BurntSushi/ripgrep#installation is installed it will be
+used to search for the files to update, otherwise they are searched in Python.
 """
 
+from __future__ import annotations
+
 import argparse
-import fileinput
-import git # pip install gitpython
-import github # pip install pygithub
+import base64
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import mmap
 import os
+import re
+import shutil
+import stat
 import subprocess
 import tempfile
-from time import sleep
-
-def get_repo_names(org_name: str, repo_regex: str, repo_topic: str,
-                   ignore_repos: list) -> list:
-    repos = []
+import threading
+from time import sleep, time
+from typing import TYPE_CHECKING
+from urllib.parse import quote
+
+if TYPE_CHECKING:
+    import httpx
+
+API_URL = "https://api.github.com"
+CACHE_DIR = os.path.expanduser("~/.cache/update-repos")
+# Seconds a cached API response is used without revalidating it
+CACHE_TTL = 300
+# Kept in separate directories so no org's files can collide with another's
+CLONE_DIR = os.path.join(CACHE_DIR, "clones")
+ETAG_CACHE_DIR = os.path.join(CACHE_DIR, "etags")
+REPO_INDEX_DIR = os.path.join(CACHE_DIR, "repos")
+# Share one SSH connection to GitHub across all of the git operations rather
+# than doing a new handshake for every clone and fetch
+GIT_SSH_COMMAND = ("ssh -o ControlMaster=auto -o ControlPersist=60s "
+                   "-o ControlPath=~/.ssh/update-repos-%C")
+GRAPHQL_URL = f"{API_URL}/graphql"
+# Files larger than this are assumed to not be something worth updating
+MAX_FILE_SIZE = 10 * 1024 * 1024
+# ripgrep is used to find files to update if it's installed
+RG_PATH = shutil.which("rg")
+# GitHub's search APIs return at most this many results
+SEARCH_LIMIT = 1000
+REPO_FIELDS = """
+fragment repoFields on Repository {
+  id
+  name
+  updatedAt
+  isArchived
+  sshUrl
+  defaultBranchRef { name }
+  repositoryTopics(first: 50) { nodes { topic { name } } }
+}
+"""
+REPOS_QUERY = REPO_FIELDS + """
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: 100, after: $cursor,
+                 orderBy: {field: UPDATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...repoFields }
+    }
+  }
+}
+"""
+SEARCH_QUERY = REPO_FIELDS + """
+query($query: String!, $cursor: String) {
+  search(query: $query, type: REPOSITORY, first: 100, after: $cursor) {
+    repositoryCount
+    pageInfo { hasNextPage endCursor }
+    nodes { ...repoFields }
+  }
+}
+"""
+CREATE_PR_MUTATION = """
+mutation($repo: ID!, $base: String!, $head: String!, $title: String!) {
+  createPullRequest(input: {repositoryId: $repo, baseRefName: $base,
+                            headRefName: $head, title: $title, body: ""}) {
+    pullRequest { url }
+  }
+}
+"""
 
-    print("Gathering list of repos, this may be slow if the organization owns "
-          "a lot of repos.")
+RepoMeta = namedtuple(
+    "RepoMeta", ["id", "ssh_url", "default_branch", "archived"])
+
+# Responses to conditional GETs keyed by URL, persisted between runs
+etag_cache = {}
+# Keep output from concurrently processed repos from interleaving
+print_lock = threading.Lock()
+# Names of repos that were deleted since the cached repo list was synced
+deleted_repos = set()
+# Limit concurrent PR creation to avoid triggering GitHub's abuse detection
+pr_semaphore = threading.Semaphore(5)
+
+def log(message: str):
+    with print_lock:
+        print(message)
+
+def create_session() -> httpx.Client:
+    # Imported here so --help and argument errors don't pay the import cost
+    import httpx # pip install httpx[http2]
+
+    # Shared by all GitHub API calls so every request after the first reuses
+    # the same connection, with HTTP/2 multiplexing concurrent requests over it
+    return httpx.Client(
+        http2=True,
+        headers={
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"bearer {os.getenv('GITHUB_TOKEN')}"},
+        timeout=30)
+
+def get_rate_limit_wait(response: httpx.Response) -> int:
+    # Seconds to wait before retrying a rate limited request, or None if the
+    # response doesn't say how long the limit lasts
+    headers = response.headers
+    if "Retry-After" in headers:
+        return int(headers["Retry-After"])
+    if headers.get("X-RateLimit-Remaining") == "0":
+        return max(int(headers["X-RateLimit-Reset"]) - int(time()), 1)
+    return None
+
+def wait_for_rate_limit(wait: int):
+    log(f"Rate limited by GitHub, retrying in {wait} seconds")
+    sleep(wait)
+
+def github_request(method: str, url: str, **kwargs) -> httpx.Response:
+    # Back off when rate limited instead of sleeping before every request
+    while True:
+        response = session.request(method, url, **kwargs)
+        if response.status_code not in (403, 429):
+            return response
+
+        wait = get_rate_limit_wait(response)
+        if wait is None and "secondary rate limit" in response.text:
+            wait = 60
+        if wait is None:
+            return response
+        wait_for_rate_limit(wait)
+
+def load_etag_cache(org_name: str):
+    try:
+        with open(os.path.join(ETAG_CACHE_DIR, f"{org_name}.json")) as file:
+            etag_cache.update(json.load(file))
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+def save_etag_cache(org_name: str):
+    os.makedirs(ETAG_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(ETAG_CACHE_DIR, f"{org_name}.json"), "w") as file:
+        json.dump(etag_cache, file)
+
+def load_repo_index(org_name: str) -> dict:
+    # Repos are keyed by ID so a renamed repo replaces its old entry
+    try:
+        with open(os.path.join(REPO_INDEX_DIR, f"{org_name}.json")) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"synced_at": None, "repos": {}}
+
+def save_repo_index(org_name: str, repo_index: dict):
+    os.makedirs(REPO_INDEX_DIR, exist_ok=True)
+    with open(os.path.join(REPO_INDEX_DIR, f"{org_name}.json"), "w") as file:
+        json.dump(repo_index, file)
+
+def remove_deleted_repos(org_name: str):
+    if not deleted_repos:
+        return
+    repo_index = load_repo_index(org_name)
+    repo_index["repos"] = {
+        repo_id: repo for repo_id, repo in repo_index["repos"].items()
+        if repo["name"] not in deleted_repos}
+    save_repo_index(org_name, repo_index)
+
+def cached_get(url: str) -> dict:
+    # Responses fetched within the last few minutes are used as is, older ones
+    # are revalidated since conditional requests answered with a 304 don't
+    # count against the rate limit
+    cached = etag_cache.get(url)
+    if cached and time() - cached["fetched_at"] < CACHE_TTL:
+        return cached["data"]
+
+    headers = {}
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+
+    response = github_request("GET", url, headers=headers)
+    if response.status_code == 304:
+        cached["fetched_at"] = time()
+        return cached["data"]
+    if response.status_code == 404:
+        etag_cache.pop(url, None)
+        return None
+
+    response.raise_for_status()
+    data = response.json()
+    etag_cache[url] = {"etag": response.headers.get("ETag"), "data": data,
+                       "fetched_at": time()}
+    return data
+
+def get_repo_meta(org_name: str, repo_name: str) -> RepoMeta:
+    data = cached_get(f"{API_URL}/repos/{org_name}/{repo_name}")
+    if data is None:
+        return None
+    return RepoMeta(data["node_id"], data["ssh_url"], data["default_branch"],
+                    data["archived"])
+
+def repo_exists(org_name: str, repo_name: str) -> bool:
+    response = github_request("GET", f"{API_URL}/repos/{org_name}/{repo_name}")
+    return response.status_code != 404
+
+def forget_repo(repo_name: str):
+    # Removed from the cached repo list at the end of the run so later runs
+    # don't try to update it again
+    log(f"WARNING: {repo_name} was not found, it may have been deleted.  "
+        "Skipping...")
+    deleted_repos.add(repo_name)
+
+def graphql(query: str, variables: dict) -> dict:
+    while True:
+        response = github_request(
+            "POST", GRAPHQL_URL, json={"query": query, "variables": variables})
+        response.raise_for_status()
+        result = response.json()
+        if "errors" not in result:
+            return result["data"]
+
+        # GraphQL reports an exhausted rate limit in a successful response
+        if not any(error.get("type") == "RATE_LIMITED"
+                   for error in result["errors"]):
+            raise RuntimeError(
+                f"GitHub GraphQL query failed: {result['errors']}")
+        wait_for_rate_limit(get_rate_limit_wait(response) or 60)
+
+def search_code(org_name: str, targets: list) -> set:
+    # Find the repos that contain a target with code search rather than
+    # cloning every repo to find out. Returns None if the search can't give a
+    # complete answer so every repo gets checked.
+    repo_names = set()
+    for target in targets:
+        try:
+            query = f'"{target.decode("utf-8")}" org:{org_name}'
+        except UnicodeDecodeError:
+            return None
+        if b'"' in target or b"\n" in target:
+            return None
+
+        for page in range(1, SEARCH_LIMIT // 100 + 1):
+            # Not cached, the responses embed every matching repo and are
+            # only needed once per run
+            response = github_request(
+                "GET", f"{API_URL}/search/code",
+                params={"q": query, "per_page": 100, "page": page})
+            response.raise_for_status()
+            data = response.json()
+            if data["incomplete_results"]:
+                return None
+            repo_names.update(
+                item["repository"]["name"] for item in data["items"])
+            if page * 100 >= data["total_count"]:
+                break
+        else:
+            return None
+    return repo_names
+
+def get_search_query(org_name: str, repo_regex: str, repo_topic: str) -> str:
+    # GitHub's topic search matches topics exactly, so a topic can be looked
+    # up without listing every repo in the organization. Its name search
+    # matches whole words instead of substrings, so a name regex always needs
+    # the full repo list to select the same repos with or without the cache.
+    # Forks are left out of search results unless asked for.
+    if repo_topic and not repo_regex:
+        return f"org:{org_name} topic:{repo_topic} archived:false fork:true"
+    return None
+
+def list_repos(org_name: str, search_query: str):
+    # Fetch names, archived status, and topics for 100 repos per request
+    # instead of paging through REST and fetching topics one repo at a time
+    cursor = None
+    while True:
+        if search_query:
+            data = graphql(
+                SEARCH_QUERY, {"query": search_query, "cursor": cursor})
+            repositories = data["search"]
+            if repositories["repositoryCount"] > SEARCH_LIMIT:
+                # Search can't page past its limit, so list every repo instead
+                yield from list_repos(org_name, None)
+                return
+        else:
+            data = graphql(REPOS_QUERY, {"org": org_name, "cursor": cursor})
+            repositories = data["organization"]["repositories"]
+
+        yield from repositories["nodes"]
+
+        if not repositories["pageInfo"]["hasNextPage"]:
+            break
+        cursor = repositories["pageInfo"]["endCursor"]
+
+def sync_repo_index(org_name: str, repo_index: dict):
+    # Repos are listed most recently updated first, so only the repos updated
+    # since the last sync need to be fetched. They're yielded as they're
+    # fetched, followed by the unchanged repos from the index.
+    synced_at = repo_index["synced_at"]
+    updated_repos = set()
+    for repo in list_repos(org_name, None):
+        if synced_at and repo["updatedAt"] < synced_at:
+            break
+        repo_index["repos"][repo["id"]] = repo
+        updated_repos.add(repo["id"])
+        if not repo_index["synced_at"] or (
+                repo["updatedAt"] > repo_index["synced_at"]):
+            repo_index["synced_at"] = repo["updatedAt"]
+        yield repo
+
+    save_repo_index(org_name, repo_index)
+    for repo_id, repo in repo_index["repos"].items():
+        if repo_id not in updated_repos:
+            yield repo
 
-    org = gh.get_organization(org_name)
-    all_repos = org.get_repos()
+def get_repo_names(org_name: str, repo_regex: str, repo_topic: str,
+                   ignore_repos: list, refresh_cache: bool):
+    # Yields the name and metadata of each matching repo as the repo list is
+    # fetched so repos can be updated while later pages are still loading
+
+    # Checked for every repo in the organization
+    ignore_repos = frozenset(ignore_repos)
+    repo_pattern = re.compile(repo_regex) if repo_regex else None
+
+    search_query = get_search_query(org_name, repo_regex, repo_topic)
+    repo_index = load_repo_index(org_name)
+    if repo_index["repos"] and not refresh_cache:
+        all_repos = sync_repo_index(org_name, repo_index)
+    elif search_query and not refresh_cache:
+        all_repos = list_repos(org_name, search_query)
+    else:
+        print("Gathering list of repos, this may be slow if the organization "
+              "owns a lot of repos.")
+        all_repos = sync_repo_index(
+            org_name, {"synced_at": None, "repos": {}})
 
     for repo in all_repos:
-        if repo.name in ignore_repos:
+        if repo["isArchived"] or repo["name"] in ignore_repos:
             continue
-        if repo_regex and repo_regex in repo.name:
-            repos.append(repo.name)
-        if repo_topic and repo_topic in repo.get_topics():
-            repos.append(repo.name)
-
-    return repos
-
-def get_file_paths(repo_path: str, target: str) -> list:
-    # Subprocess out to ag since it's much more efficient
-    raw_result = subprocess.run(["ag", "-l", target], cwd=repo_path,
-                                capture_output=True)
-    return raw_result.stdout.decode("utf-8").splitlines()
-
-def update_file(file_path: str, target: str, replacement: str):
+        topics = [node["topic"]["name"]
+                  for node in repo["repositoryTopics"]["nodes"]]
+        if not repo["defaultBranchRef"]:
+            continue # empty repo, nothing to update
+        if ((repo_pattern and repo_pattern.search(repo["name"])) or
+                (repo_topic and repo_topic in topics)):
+            yield repo["name"], RepoMeta(
+                repo["id"], repo["sshUrl"],
+                repo["defaultBranchRef"]["name"], False)
+
+def is_binary(file) -> bool:
+    # Same heuristic as ag and git: a NUL byte near the start means binary
+    return b"\0" in file.read(8192)
+
+def search_with_rg(repo_path: str, targets: list) -> list:
+    # Match the in-process scan: include hidden and ignored files, skip .git,
+    # and skip large files. Binary files and symlinks are skipped by default.
+    # Ignore files are only meant for untracked files and the clone is
+    # cleaned before every run, so any file they match here is tracked.
+    # The user's ripgrep config is skipped so it can't exclude files.
+    result = subprocess.run(
+        [RG_PATH, "--files-with-matches", "--fixed-strings", "--null",
+         "--no-config", "--no-messages", "--hidden", "--no-ignore",
+         "--glob=!.git", f"--max-filesize={MAX_FILE_SIZE}",
+         *(b"--regexp=" + target for target in targets)],
+        cwd=repo_path, capture_output=True)
+    # Exits with 2 on any error, even if it found matches in other files
+    if result.returncode == 2 and not result.stdout:
+        stderr = result.stderr.decode(errors="replace").strip()
+        raise RuntimeError(f"rg failed: {stderr}")
+    return [os.fsdecode(path) for path in result.stdout.split(b"\0") if path]
+
+def update_files(repo_path: str, pattern: re.Pattern, replacements: dict):
+    # ripgrep searches in parallel so it is much faster on large repos, but it
+    # can't search for a literal newline without switching to multiline mode,
+    # and a NUL can't be passed to it as an argument
+    if RG_PATH and not any(b"\n" in target or b"\0" in target
+                           for target in replacements):
+        for file_path in search_with_rg(repo_path, list(replacements)):
+            if update_file(os.path.join(repo_path, file_path), pattern,
+                           replacements):
+                yield file_path
+    else:
+        yield from scan_and_update_files(repo_path, pattern, replacements)
+
+def scan_and_update_files(
+        repo_path: str, pattern: re.Pattern, replacements: dict):
+    # Scan in process rather than forking a search tool for every repo,
+    # replacing the target as each file is searched rather than reading the
+    # file a second time. Paths are kept as bytes so only the changed ones are
+    # ever decoded.
+    root = os.fsencode(repo_path)
+    directories = [root]
+    while directories:
+        # Read the whole directory before rewriting any of its files so the
+        # rewritten files aren't seen again
+        with os.scandir(directories.pop()) as entries:
+            entries = list(entries)
+        for entry in entries:
+            # Worktrees have a .git file pointing at the clone's .git dir
+            if entry.name == b".git" or entry.is_symlink():
+                continue
+            if entry.is_dir():
+                directories.append(entry.path)
+                continue
+            if entry.stat().st_size > MAX_FILE_SIZE:
+                continue
+            if update_file(os.fsdecode(entry.path), pattern, replacements,
+                           skip_binary=True):
+                yield os.fsdecode(os.path.relpath(entry.path, root))
+
+def update_file(file_path: str, pattern: re.Pattern, replacements: dict,
+                skip_binary: bool = False) -> bool:
+    # Search the mapped file and only copy its contents out if it contains
+    # a target, then replace every target across the whole file in one pass
     try:
-        with fileinput.FileInput(file_path, inplace=True) as file:
-            for line in file:
-                print(line.replace(target, replacement), end='')
+        with open(file_path, "rb") as file:
+            file_stat = os.fstat(file.fileno())
+            if file_stat.st_size == 0:
+                return False # empty files can't be mapped
+            if skip_binary and is_binary(file):
+                return False
+            with mmap.mmap(file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as contents:
+                if not contains_target(contents, pattern, replacements):
+                    return False
+                contents = contents[:]
     except FileNotFoundError:
-        print(f"WARNING: File {file_path} was not found.")
+        log(f"WARNING: File {file_path} was not found.")
+        return False
+
+    new_contents = replace_targets(contents, pattern, replacements)
+    if new_contents == contents:
+        return False
+
+    write_file(file_path, new_contents, stat.S_IMODE(file_stat.st_mode))
+    return True
+
+def contains_target(
+        contents: bytes, pattern: re.Pattern, replacements: dict) -> bool:
+    # The usual single target is found with a plain search, which is much
+    # faster than matching the alternation of every target
+    if len(replacements) == 1:
+        return contents.find(next(iter(replacements))) != -1
+    return pattern.search(contents) is not None
+
+def replace_targets(
+        contents: bytes, pattern: re.Pattern, replacements: dict) -> bytes:
+    # Likewise a single target is replaced in one C-level bytes.replace
+    # rather than calling back into Python for every match
+    if len(replacements) == 1:
+        [(target, replacement)] = replacements.items()
+        return contents.replace(target, replacement)
+    return pattern.sub(lambda match: replacements[match[0]], contents)
+
+def write_file(file_path: str, contents: bytes, mode: int):
+    # Write to a temp file and rename it so the file is never left partially
+    # written. Setting the original permissions on the open file avoids
+    # another stat and path lookup per file compared to shutil.copymode.
+    # The temp file gets a unique name so it can't clobber a tracked file.
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path), prefix=".update-repos-")
+    try:
+        with open(fd, "wb") as file:
+            os.fchmod(file.fileno(), mode)
+            file.write(contents)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def run_git(repo_path: str, *args: str, text: bool = True):
+    # Call git directly, GitPython is slow to import and starts a git process
+    # for each of these commands anyway
+    result = subprocess.run(
+        ["git", "-C", repo_path, *args], capture_output=True)
+    if result.returncode:
+        stderr = result.stderr.decode(errors="replace").strip()
+        raise RuntimeError(f"git {' '.join(args)} failed: {stderr}")
+    return result.stdout.decode().strip() if text else result.stdout
+
+def use_shared_ssh_connection():
+    # Leave any SSH command the user configured alone, e.g. one that picks
+    # the key for a particular GitHub account
+    if os.getenv("GIT_SSH_COMMAND") or os.getenv("GIT_SSH"):
+        return
+    result = subprocess.run(["git", "config", "--get", "core.sshCommand"],
+                            capture_output=True)
+    if result.stdout.strip():
+        return
+    os.environ["GIT_SSH_COMMAND"] = GIT_SSH_COMMAND
+
+def set_sparse_checkout(repo_path: str, target_file: str):
+    # Only check out the file that will be changed when it's known
+    if target_file:
+        run_git(repo_path, "sparse-checkout", "set", "--no-cone",
+                f"/{target_file}")
+    elif run_git(repo_path, "config", "--type=bool", "--default=false",
+                 "--get", "core.sparseCheckout") == "true":
+        run_git(repo_path, "sparse-checkout", "disable")
 
 def update_repo(
-        org_name: str, repo_name: str, parent_directory: str,
-        base_branch: str, branch_name: str, commit_message: str,
-        target_file: str, target: str, replacement: str, pr: bool) -> str:
-    remote_repo = gh.get_repo(f"{org_name}/{repo_name}")
+        org_name: str, repo_name: str, repo_meta: RepoMeta,
+        parent_directory: str, base_branch: str, branch_name: str,
+        commit_message: str, target_file: str, pattern: re.Pattern,
+        replacements: dict, pr: bool, clone_depth: int) -> str:
+    if repo_meta is None:
+        repo_meta = get_repo_meta(org_name, repo_name)
+        if repo_meta is None:
+            forget_repo(repo_name)
+            return
 
-    if remote_repo.archived:
-        print(f"WARNING: {repo_name} is archived.  Skipping...")
+    if repo_meta.archived:
+        log(f"WARNING: {repo_name} is archived.  Skipping...")
         return
 
+    if target_file and pr:
+        pr_urls = update_remote_file(
+            org_name, repo_name, repo_meta, base_branch, branch_name,
+            commit_message, target_file, pattern, replacements)
+        if pr_urls is not False:
+            return pr_urls
+
     repo_path = os.path.join(parent_directory, repo_name)
-    print(f"Cloning {repo_name} to {repo_path}")
-    repo = git.Repo.clone_from(remote_repo.ssh_url, repo_path)
+    # Repo names can't contain "@" so this can't collide with another repo
+    worktree_path = f"{repo_path}@{branch_name.replace('/', '-')}"
+    depth_options = [f"--depth={clone_depth}"] if clone_depth else []
+    clone_path = None
+
+    if os.path.isdir(os.path.join(repo_path, ".git")):
+        try:
+            run_git(repo_path, "fetch", *depth_options, "origin",
+                    repo_meta.default_branch)
+        except RuntimeError:
+            if repo_exists(org_name, repo_name):
+                raise
+            forget_repo(repo_name)
+            return
+        # Discard the worktree from a previous run for this branch
+        shutil.rmtree(worktree_path, ignore_errors=True)
+        run_git(repo_path, "worktree", "prune")
+
+        # Empty when the HEAD is detached
+        current_branch = run_git(repo_path, "branch", "--show-current")
+        if current_branch in ("", repo_meta.default_branch, branch_name):
+            # Reuse the clone from a previous run, resetting it to match the
+            # remote's default branch
+            log(f"Updating {repo_name} in {repo_path}")
+            set_sparse_checkout(repo_path, target_file)
+            run_git(repo_path, "checkout", "--force", "-B",
+                    repo_meta.default_branch, "FETCH_HEAD")
+            run_git(repo_path, "clean", "-fdx")
+            run_git(repo_path, "update-ref", "-d", f"refs/heads/{branch_name}")
+        else:
+            # The clone has changes for another branch checked out that may
+            # still be under review, so rather than discarding them, make
+            # this change in a worktree that shares the clone's objects
+            log(f"Creating worktree of {repo_name} in {worktree_path}")
+            run_git(repo_path, "update-ref", "-d", f"refs/heads/{branch_name}")
+            run_git(repo_path, "worktree", "add", "--no-checkout", "--detach",
+                    worktree_path, "FETCH_HEAD")
+            clone_path = repo_path
+            repo_path = worktree_path
+            set_sparse_checkout(repo_path, target_file)
+            run_git(repo_path, "reset", "--hard")
+    else:
+        log(f"Cloning {repo_name} to {repo_path}")
+        # Only the tip of the default branch is needed to make the change
+        clone_options = ["--single-branch", "--no-tags",
+                         f"--branch={repo_meta.default_branch}"]
+        if target_file or not clone_depth:
+            # Only download the blobs that are checked out rather than every
+            # version of every file in the repo's history
+            clone_options.append("--filter=blob:none")
+        if target_file:
+            # Only check out the one file that will be changed rather than the
+            # repo's entire working tree
+            clone_options.append("--no-checkout")
+        try:
+            run_git(parent_directory, "clone", *clone_options,
+                    *depth_options, repo_meta.ssh_url, repo_name)
+        except RuntimeError:
+            if repo_exists(org_name, repo_name):
+                raise
+            forget_repo(repo_name)
+            return
+        if target_file:
+            set_sparse_checkout(repo_path, target_file)
+            run_git(repo_path, "checkout", repo_meta.default_branch)
 
     if target_file:
         file_paths = [target_file]
+        if not update_file(os.path.join(repo_path, target_file), pattern,
+                           replacements):
+            file_paths = []
     else:
-        file_paths = get_file_paths(repo_path, target)
-        if not file_paths:
-            print(f"No matches found in or changes made to {repo_name}")
-            return
-        print(f"Matches found in: {file_paths}")
-
-    for file_path in file_paths:
-        update_file(
-            os.path.join(repo_path, file_path),
-            target,
-            replacement)
-
-    branch = repo.create_head(branch_name)
-    branch.checkout()
+        file_paths = list(update_files(repo_path, pattern, replacements))
 
-    try:
-        repo.git.commit("-a", "-m", commit_message)
-    except (git.exc.GitCommandError):
-        print(f"No matches found in or changes made to {repo_name}")
+    if not file_paths:
+        log(f"No matches found in or changes made to {repo_name}")
         return
+    log(f"Matches found in {repo_name}: {file_paths}")
 
     if pr:
-        return create_pr(repo, remote_repo, repo_name, base_branch, branch_name,
-                         commit_message)
+        # Commit the changed files through the API rather than committing
+        # locally and negotiating a push
+        parent_sha, base_tree_sha = run_git(
+            repo_path, "rev-parse", "HEAD", "HEAD^{tree}").split()
+        create_remote_commit(
+            org_name, repo_name, repo_path, parent_sha, base_tree_sha,
+            branch_name, commit_message, file_paths)
+        pr_urls = create_pr(repo_meta, base_branch, branch_name,
+                            commit_message)
+        if clone_path:
+            # The branch has been created so the worktree is no longer needed
+            run_git(clone_path, "worktree", "remove", "--force", repo_path)
+        return pr_urls
     else:
-        return [f"{repo_name}/{file_path}" for file_path in file_paths]
+        # Only files that were changed are listed, so there is always
+        # something to commit here
+        run_git(repo_path, "checkout", "-b", branch_name)
+        run_git(repo_path, "commit", "-a", "-m", commit_message)
+        repo_dir = os.path.basename(repo_path)
+        return [f"{repo_dir}/{file_path}" for file_path in file_paths]
+
+def create_remote_commit(
+        org_name: str, repo_name: str, repo_path: str, parent_sha: str,
+        base_tree_sha: str, branch_name: str, commit_message: str,
+        file_paths: list):
+    # Build the commit with the Git Data API: a blob per changed file, a tree
+    # on top of the parent's tree, the commit, and then the branch pointing
+    # at it
+    repo_url = f"{API_URL}/repos/{org_name}/{repo_name}"
+
+    # Stage the files so the blobs are what git would commit, with line
+    # ending conversion and clean filters such as LFS applied
+    run_git(repo_path, "add", "--", *file_paths)
+    staged_files = run_git(
+        repo_path, "ls-files", "--stage", "-z", "--", *file_paths)
+
+    tree = []
+    for staged_file in staged_files.split("\0"):
+        if not staged_file:
+            continue
+        file_info, file_path = staged_file.split("\t", 1)
+        mode, blob_sha, _ = file_info.split()
+        contents = run_git(repo_path, "cat-file", "blob", blob_sha, text=False)
+        response = github_request("POST", f"{repo_url}/git/blobs", json={
+            "content": base64.b64encode(contents).decode("ascii"),
+            "encoding": "base64"})
+        response.raise_for_status()
+        tree.append({
+            "path": file_path,
+            "mode": mode,
+            "type": "blob",
+            "sha": response.json()["sha"]})
+
+    response = github_request("POST", f"{repo_url}/git/trees", json={
+        "base_tree": base_tree_sha, "tree": tree})
+    response.raise_for_status()
+    response = github_request("POST", f"{repo_url}/git/commits", json={
+        "message": commit_message,
+        "tree": response.json()["sha"],
+        "parents": [parent_sha]})
+    response.raise_for_status()
+    create_branch(repo_url, branch_name, response.json()["sha"])
+
+def create_branch(repo_url: str, branch_name: str, sha: str):
+    response = github_request("POST", f"{repo_url}/git/refs", json={
+        "ref": f"refs/heads/{branch_name}", "sha": sha})
+    response.raise_for_status()
+
+def delete_branch(repo_url: str, branch_name: str):
+    response = github_request(
+        "DELETE", f"{repo_url}/git/refs/heads/{branch_name}")
+    response.raise_for_status()
+
+def update_remote_file(
+        org_name: str, repo_name: str, repo_meta: RepoMeta, base_branch: str,
+        branch_name: str, commit_message: str, target_file: str,
+        pattern: re.Pattern, replacements: dict) -> list:
+    # When the file is known, make the change through the contents API rather
+    # than cloning and pushing the repo. Returns False if the file is too
+    # large for the contents API so the caller falls back to cloning.
+    repo_url = f"{API_URL}/repos/{org_name}/{repo_name}"
+    contents_url = f"{repo_url}/contents/{quote(target_file)}"
+
+    response = github_request(
+        "GET", contents_url, params={"ref": repo_meta.default_branch})
+    if response.status_code == 404:
+        if not repo_exists(org_name, repo_name):
+            forget_repo(repo_name)
+            return
+        log(f"WARNING: File {repo_name}/{target_file} was not found.")
+        return
+    response.raise_for_status()
+    file_data = response.json()
+    # A list of the directory's contents is returned for a directory
+    if not isinstance(file_data, dict):
+        log(f"WARNING: File {repo_name}/{target_file} was not found.")
+        return
+    if file_data.get("encoding") != "base64":
+        return False
 
-def create_pr(
-        repo, remote_repo, repo_name: str, base_branch: str, branch_name: str,
-        commit_message: str) -> str:
-    if base_branch is None:
-        base_branch = remote_repo.default_branch
+    contents = base64.b64decode(file_data["content"])
+    new_contents = replace_targets(contents, pattern, replacements)
+    if new_contents == contents:
+        log(f"No matches found in or changes made to {repo_name}")
+        return
+    log(f"Matches found in {repo_name}: {[target_file]}")
+
+    response = github_request(
+        "GET", f"{repo_url}/git/ref/heads/{repo_meta.default_branch}")
+    response.raise_for_status()
+    create_branch(repo_url, branch_name, response.json()["object"]["sha"])
 
-    repo.git.push()
-    sleep(2) # To avoid GitHub rate limiting if updating more than 10 repos
-    pr = remote_repo.create_pull(
-        title=commit_message,
-        body="", # required or the package assumes the PR is based on an issue
-        head=branch_name,
-        base=base_branch)
+    try:
+        response = github_request("PUT", contents_url, json={
+            "message": commit_message,
+            "content": base64.b64encode(new_contents).decode("ascii"),
+            "sha": file_data["sha"],
+            "branch": branch_name})
+        response.raise_for_status()
+    except Exception:
+        # Don't leave behind an empty branch that would make the next run
+        # with the same branch name fail
+        delete_branch(repo_url, branch_name)
+        raise
+
+    return create_pr(repo_meta, base_branch, branch_name, commit_message)
 
-    print(f"Created {pr.html_url}")
-    return [pr.html_url]
+def create_pr(
+        repo_meta: RepoMeta, base_branch: str, branch_name: str,
+        commit_message: str) -> list:
+    if base_branch is None:
+        base_branch = repo_meta.default_branch
+
+    with pr_semaphore:
+        data = graphql(CREATE_PR_MUTATION, {
+            "repo": repo_meta.id,
+            "base": base_branch,
+            "head": branch_name,
+            "title": commit_message})
+
+    pr_url = data["createPullRequest"]["pullRequest"]["url"]
+    log(f"Created {pr_url}")
+    return [pr_url]
+
+def read_replacement_file(replacement_file: str) -> dict:
+    # Each line is a target and its replacement separated by a tab
+    replacements = {}
+    with open(replacement_file, "rb") as file:
+        for line in file:
+            line = line.rstrip(b"\r\n")
+            if not line:
+                continue
+            target, tab, replacement = line.partition(b"\t")
+            if not tab or not target:
+                raise ValueError(
+                    f"Invalid line in {replacement_file}: {line!r}")
+            replacements[target] = replacement
+    return replacements
 
 def main(org_name: str, repo_regex: str, repo_topic: str, repo_list: list,
          ignore_repos: list, base_branch: str, branch_name: str,
          commit_message: str, target_file: str, target: str, replacement: str,
-         pr: bool):
+         replacement_file: str, pr: bool, jobs: int, clone_depth: int,
+         work_dir: str, refresh_cache: bool, code_search: bool):
     results = []
+    failed_repos = []
 
     # Validate repo selection arguments
     if not repo_regex and not repo_topic and not repo_list:
@@ -129,24 +791,81 @@ def main(org_name: str, repo_regex: str, repo_topic: str, repo_list: list,
         raise ValueError(
             "Cannot specify both repo-list and repo-regex or repo-topic.")
 
-    # Select repos
+    # Validate replacement arguments
+    if (target is None) != (replacement is None):
+        raise ValueError("Must specify both target and replacement.")
+    if target is None and not replacement_file:
+        raise ValueError(
+            "Must specify target and replacement or replacement-file.")
+    if target == "":
+        raise ValueError("Target cannot be empty.")
+
+    load_etag_cache(org_name)
+    use_shared_ssh_connection()
+
+    # Encode once rather than for every file in every repo
+    replacements = {}
+    if replacement_file:
+        replacements.update(read_replacement_file(replacement_file))
+    if target is not None:
+        replacements[target.encode("utf-8")] = replacement.encode("utf-8")
+    if not replacements:
+        raise ValueError(f"No targets found in {replacement_file}.")
+    # Find every target in one pass over each file rather than running the
+    # whole update once per target. Longer targets are tried first so one
+    # that starts with another target isn't shadowed by it.
+    pattern = re.compile(b"|".join(
+        map(re.escape, sorted(replacements, key=len, reverse=True))))
+
+    # Select repos, metadata for a provided list is looked up per repo
     if repo_list:
-        repo_names = repo_list
+        repos = dict.fromkeys(repo_list).items()
     else:
-        repo_names = get_repo_names(org_name, repo_regex, repo_topic, ignore_repos)
-
-    print(f"The following repos will be checked: {repo_names}")
-
-    parent_directory = tempfile.TemporaryDirectory().name
-    print(f"Directory created at {parent_directory}")
-
-    for repo_name in repo_names:
-        result_paths = update_repo(
-            org_name, repo_name, parent_directory, base_branch, branch_name,
-            commit_message, target_file, target, replacement, pr)
-
-        if result_paths is not None:
-            results.extend(result_paths)
+        repos = get_repo_names(
+            org_name, repo_regex, repo_topic, ignore_repos, refresh_cache)
+
+    matching_repos = None
+    if code_search:
+        matching_repos = search_code(org_name, list(replacements))
+        if matching_repos is None:
+            print("Code search can't list every match, checking all repos")
+
+    # Absolute so git resolves worktree paths against the cwd rather than
+    # the clone it's run in
+    parent_directory = os.path.abspath(os.path.join(work_dir, org_name))
+    os.makedirs(parent_directory, exist_ok=True)
+    print(f"Using directory {parent_directory}")
+
+    # Each repo is dominated by network I/O (clone, fetch, API calls) so
+    # process them concurrently, starting each one as soon as it's listed
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for repo_name, repo_meta in repos:
+                if (matching_repos is not None and
+                        repo_name not in matching_repos):
+                    continue
+                log(f"Checking {repo_name}")
+                future = executor.submit(
+                    update_repo, org_name, repo_name, repo_meta,
+                    parent_directory, base_branch, branch_name,
+                    commit_message, target_file, pattern, replacements, pr,
+                    clone_depth)
+                futures[future] = repo_name
+
+            # One repo failing shouldn't stop the others from being updated
+            for future in as_completed(futures):
+                try:
+                    result_paths = future.result()
+                except Exception as error:
+                    log(f"ERROR: Failed to update {futures[future]}: {error}")
+                    failed_repos.append(futures[future])
+                    continue
+                if result_paths is not None:
+                    results.extend(result_paths)
+    finally:
+        save_etag_cache(org_name)
+        remove_deleted_repos(org_name)
 
     print()
     if not results:
@@ -161,6 +880,10 @@ def main(org_name: str, repo_regex: str, repo_topic: str, repo_list: list,
         if not pr:
             print("\nRerun this command with '--pr' if you would like the "
                   "changes to be pushed up and a PR opened.")
+    if failed_repos:
+        print("\nFailed to update the following repos, see the errors above:")
+        for repo_name in failed_repos:
+            print(repo_name)
 
 def parser():
     parser = argparse.ArgumentParser()
@@ -168,7 +891,9 @@ def parser():
         "--org-name", required=True, help="Github Organization")
     parser.add_argument(
         "--repo-regex",
-        help="Repo name regex to determine which repos to change")
+        help="Repo name regex to determine which repos to change, matched "
+             "anywhere in the name so a plain name selects every repo whose "
+             "name contains it")
     parser.add_argument(
         "--repo-topic",
         help="Repo topic to determine which repos to change")
@@ -176,7 +901,7 @@ def parser():
         "--repo-list", default=[], nargs="*",
         help="List of repo names to change")
     parser.add_argument(
-        "--ignore-repos", default=[], nargs="*",
+        "--ignore-repos", default=(), nargs="*",
         help="List of names of repos to skip")
     parser.add_argument(
         "--base-branch",
@@ -190,22 +915,50 @@ def parser():
     parser.add_argument(
         "--target-file",
         help="Path within the repo of the file to do the replacement in, "
-             "default searches all files")
+             "default searches all files. With --pr the file is updated "
+             "through the GitHub API without cloning the repo")
+    parser.add_argument(
+        "--target", help="String to find and replace")
     parser.add_argument(
-        "--target", required=True, help="String to find and replace")
+        "--replacement", help="String to replace old_string with")
     parser.add_argument(
-        "--replacement", required=True,
-        help="String to replace old_string with")
+        "--replacement-file",
+        help="File of targets and replacements to make at the same time, one "
+             "per line separated by a tab. Can be combined with --target and "
+             "--replacement")
     parser.add_argument(
         "--pr", action="store_true",
         help="If the change should be pushed up and a PR created")
+    parser.add_argument(
+        "--jobs", "--workers", type=int,
+        default=min(8, (os.cpu_count() or 1) * 4),
+        help="Number of repos to process concurrently")
+    parser.add_argument(
+        "--clone-depth", type=int, default=1,
+        help="Number of commits of history to clone, 0 clones the full "
+             "history")
+    parser.add_argument(
+        "--work-dir", default=CLONE_DIR,
+        help="Directory to clone repos into. Clones are reused by later runs "
+             "so only new commits need to be fetched")
+    parser.add_argument(
+        "--refresh-cache", action="store_true",
+        help="Rebuild the cached list of the organization's repos, use if "
+             "repos have been deleted or renamed since the last run")
+    parser.add_argument(
+        "--code-search", action="store_true",
+        help="Only check repos that GitHub's code search finds a target in. "
+             "Faster when few repos contain the target, but the search index "
+             "can lag behind recent commits, skips large files and forks, "
+             "and only matches whole tokens, so a target inside a longer "
+             "word (oo=1 in foo=1) is missed")
 
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parser()
 
-    gh = github.Github(os.getenv("GITHUB_TOKEN"))
+    session = create_session()
 
     main(
         args.org_name,
@@ -219,4 +972,10 @@ if __name__ == "__main__":
         args.target_file,
         args.target,
         args.replacement,
-        args.pr)
+        args.replacement_file,
+        args.pr,
+        args.jobs,
+        args.clone_depth,
+        args.work_dir,
+        args.refresh_cache,
+        args.code_search)